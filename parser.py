@@ -1,16 +1,34 @@
 import requests
 from bs4 import BeautifulSoup
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 import time
 import sqlite3
 import logging
 import sys
 import os
+import gzip
+import json
+import hashlib
+import argparse
+import zlib
 
 # Путь к базе данных (должен совпадать с render.yaml)
 DB_PATH = '/app/data/currency_data.db'
 
+# Архив сырых HTML-страниц для повторного разбора (на том же томе, что и БД)
+ARCHIVE_DIR = '/app/data/html_archive'
+ARCHIVE_INDEX_NAME = 'index.jsonl'
+# Сохранение HTML включается переменной окружения PARSER_ARCHIVE_HTML=1
+ARCHIVE_ENABLED = os.environ.get('PARSER_ARCHIVE_HTML', '0') == '1'
+# Срок хранения страниц в архиве (дней) по умолчанию, см. get_archive_retention_days
+DEFAULT_ARCHIVE_RETENTION_DAYS = 30
+
+SOURCE_URL = 'https://myfin.by/currency/minsk'
+# Ожидаемое количество банков и курсов на странице (для оценки покрытия)
+EXPECTED_BANKS = 2
+EXPECTED_RATES = EXPECTED_BANKS * 3
+
 def setup_logger():
     """Настраивает логгер для Render"""
     logger = logging.getLogger('currency_parser')
@@ -29,6 +47,27 @@ def setup_logger():
 
 logger = setup_logger()
 
+def get_archive_retention_days():
+    """Читает срок хранения архива из PARSER_ARCHIVE_RETENTION_DAYS, при ошибке берет значение по умолчанию"""
+    value = os.environ.get('PARSER_ARCHIVE_RETENTION_DAYS')
+    if value is None:
+        return DEFAULT_ARCHIVE_RETENTION_DAYS
+    try:
+        days = int(value)
+    except ValueError:
+        days = 0
+    # 0 и меньше удалили бы только что сохраненную страницу
+    if days <= 0:
+        logger.warning(
+            f"Некорректный PARSER_ARCHIVE_RETENTION_DAYS={value!r}, "
+            f"используется {DEFAULT_ARCHIVE_RETENTION_DAYS}"
+        )
+        return DEFAULT_ARCHIVE_RETENTION_DAYS
+    return days
+
+# Страницы старше этого срока удаляются из архива после каждой загрузки
+ARCHIVE_RETENTION_DAYS = get_archive_retention_days()
+
 def connect_db_with_retry(retries=3, delay=1):
     """Подключается к БД с повторными попытками при блокировке"""
     for attempt in range(retries):
@@ -143,28 +182,127 @@ def fetch_currency_data(url, max_retries=3):
                 time.sleep(2)
     return None
 
-def parse_currency_data():
-    """Основная функция парсинга данных"""
-    formatted_datetime = get_moscow_time()
-    logger.info(f"Начало парсинга: {formatted_datetime}")
-    
-    url = 'https://myfin.by/currency/minsk'
-    html_content = fetch_currency_data(url)
-    
-    if not html_content:
-        logger.error("Не удалось получить данные с сайта")
+def parse_rate(value):
+    """Преобразует строку курса в число, возвращает None при ошибке"""
+    try:
+        return float(value.replace(',', '.'))
+    except (ValueError, AttributeError):
+        return None
+
+def get_archive_index_path(archive_dir=None):
+    """Возвращает путь к индексу архива (по умолчанию ARCHIVE_DIR)"""
+    return os.path.join(archive_dir or ARCHIVE_DIR, ARCHIVE_INDEX_NAME)
+
+def archive_html(html_content, formatted_datetime, url, archive_dir=None):
+    """Сохраняет сжатый HTML в архив по SHA-256 содержимого и дописывает индекс"""
+    archive_dir = archive_dir or ARCHIVE_DIR
+    data = html_content.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()
+    page_dir = os.path.join(archive_dir, digest[:2])
+    page_path = os.path.join(page_dir, f"{digest}.html.gz")
+
+    try:
+        os.makedirs(page_dir, exist_ok=True)
+        if not os.path.exists(page_path):
+            tmp_path = f"{page_path}.tmp"
+            with gzip.open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, page_path)
+            logger.info(f"HTML сохранен в архив: {digest[:12]}")
+        else:
+            logger.info(f"HTML уже есть в архиве: {digest[:12]}")
+
+        with open(get_archive_index_path(archive_dir), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({
+                "sha256": digest,
+                "date_time": formatted_datetime,
+                "url": url
+            }, ensure_ascii=False) + "\n")
+        return digest
+    except OSError as e:
+        # Ошибка архива не должна мешать основному парсингу
+        logger.error(f"Ошибка сохранения HTML в архив: {e}")
+        return None
+
+def load_archived_html(digest, archive_dir=None):
+    """Читает HTML из архива по SHA-256"""
+    page_path = os.path.join(archive_dir or ARCHIVE_DIR, digest[:2], f"{digest}.html.gz")
+    with gzip.open(page_path, 'rb') as f:
+        return f.read().decode('utf-8')
+
+def read_archive_index(archive_dir=None):
+    """Возвращает записи индекса архива в порядке добавления"""
+    index_path = get_archive_index_path(archive_dir)
+    if not os.path.exists(index_path):
         return []
 
+    entries = []
+    with open(index_path, encoding='utf-8') as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Поврежденная строка индекса архива: {line_num}")
+                continue
+            if not isinstance(entry, dict) or not isinstance(entry.get("sha256"), str) \
+                    or not entry["sha256"]:
+                logger.warning(f"Некорректная запись индекса архива: {line_num}")
+                continue
+            entries.append(entry)
+    return entries
+
+def prune_archive(cutoff, archive_dir=None):
+    """Удаляет из архива записи старше cutoff (ГГГГ-ММ-ДД ЧЧ:ММ) и ненужные файлы страниц"""
+    archive_dir = archive_dir or ARCHIVE_DIR
+    index_path = get_archive_index_path(archive_dir)
+    entries = read_archive_index(archive_dir)
+    # Формат date_time позволяет сравнивать строки напрямую
+    kept = [
+        entry for entry in entries
+        if isinstance(entry.get("date_time"), str) and entry["date_time"] >= cutoff
+    ]
+    if len(kept) == len(entries):
+        return 0
+
+    try:
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in kept:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, index_path)
+
+        # Одна страница может быть в индексе несколько раз, удаляем только неиспользуемые
+        kept_digests = {entry.get("sha256") for entry in kept}
+        removed_files = 0
+        for entry in entries:
+            digest = entry.get("sha256", "")
+            if not digest or digest in kept_digests:
+                continue
+            page_path = os.path.join(archive_dir, digest[:2], f"{digest}.html.gz")
+            if os.path.exists(page_path):
+                os.remove(page_path)
+                removed_files += 1
+    except OSError as e:
+        logger.error(f"Ошибка очистки архива HTML: {e}")
+        return 0
+
+    logger.info(
+        f"Очистка архива HTML: удалено записей {len(entries) - len(kept)}, файлов {removed_files}"
+    )
+    return removed_files
+
+def extract_currency_data(html_content, formatted_datetime):
+    """Извлекает курсы из HTML, возвращает (данные, список проблем разбора)"""
     soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # Упрощенный и более надежный парсинг
     currencies = []
-    
+    problems = []
+
     # Парсинг лучших курсов
-    best_rates = []
-    for span in soup.select('span.accent'):
-        best_rates.append(span.text.strip())
-    
+    best_rates = [span.text.strip() for span in soup.select('span.accent')]
+
     if len(best_rates) >= 6:
         currencies.append({
             "date_time": formatted_datetime,
@@ -175,10 +313,13 @@ def parse_currency_data():
                 {"currency": "RUB 100", "buy": best_rates[5], "sell": best_rates[4]}
             ]
         })
+    else:
+        problems.append(f"Лучший курс: найдено {len(best_rates)} значений span.accent, ожидалось 6")
 
     # Парсинг БелВЭБ
     belveb_row = None
-    for row in soup.select('tr.currencies-courses__row-main'):
+    rows = soup.select('tr.currencies-courses__row-main')
+    for row in rows:
         if 'belveb' in row.get_text().lower():
             belveb_row = row
             break
@@ -195,6 +336,47 @@ def parse_currency_data():
                     {"currency": "RUB 100", "buy": cells[5].text.strip(), "sell": cells[4].text.strip()}
                 ]
             })
+        else:
+            problems.append(f"БелВЭБ: найдено {len(cells)} ячеек курсов, ожидалось 6")
+    else:
+        problems.append(f"БелВЭБ: строка не найдена среди {len(rows)} строк таблицы")
+
+    # Проверка числовых значений
+    for bank in currencies:
+        for rate in bank["rates"]:
+            for side in ("buy", "sell"):
+                if parse_rate(rate[side]) is None:
+                    problems.append(
+                        f"{bank['bank_name']} {rate['currency']}: "
+                        f"некорректное значение {side}={rate[side]!r}"
+                    )
+
+    return currencies, problems
+
+def parse_currency_data():
+    """Основная функция парсинга данных"""
+    formatted_datetime = get_moscow_time()
+    logger.info(f"Начало парсинга: {formatted_datetime}")
+    
+    html_content = fetch_currency_data(SOURCE_URL)
+    
+    if not html_content:
+        logger.error("Не удалось получить данные с сайта")
+        return []
+
+    currencies, problems = extract_currency_data(html_content, formatted_datetime)
+    for problem in problems:
+        logger.error(f"Ошибка разбора страницы: {problem}")
+
+    if ARCHIVE_ENABLED:
+        # Ошибка архива не должна мешать сохранению курсов
+        try:
+            archive_html(html_content, formatted_datetime, SOURCE_URL)
+            moscow_tz = pytz.timezone('Europe/Moscow')
+            cutoff = datetime.now(moscow_tz) - timedelta(days=ARCHIVE_RETENTION_DAYS)
+            prune_archive(cutoff.strftime('%Y-%m-%d %H:%M'))
+        except Exception as e:
+            logger.error(f"Ошибка работы с архивом HTML: {e}")
 
     logger.info(f"Собрано банков: {len(currencies)}")
     return currencies
@@ -212,14 +394,15 @@ def save_to_database(data):
             
         cursor = conn.cursor()
         inserted_rows = 0
+        skipped_rows = 0
         
         for bank in data:
             for rate in bank["rates"]:
-                try:
-                    buy = float(rate["buy"].replace(',', '.'))
-                    sell = float(rate["sell"].replace(',', '.'))
-                except ValueError:
-                    logger.warning(f"Ошибка преобразования курса: {rate}")
+                buy = parse_rate(rate["buy"])
+                sell = parse_rate(rate["sell"])
+                if buy is None or sell is None:
+                    logger.error(f"Ошибка преобразования курса {bank['bank_name']}: {rate}")
+                    skipped_rows += 1
                     continue
                     
                 cursor.execute("""
@@ -237,6 +420,8 @@ def save_to_database(data):
         
         conn.commit()
         logger.info(f"Сохранено записей: {inserted_rows}")
+        if skipped_rows:
+            logger.error(f"Пропущено записей с некорректными курсами: {skipped_rows}")
         return inserted_rows
         
     except sqlite3.Error as e:
@@ -246,19 +431,150 @@ def save_to_database(data):
         if conn:
             conn.close()
 
-def main():
-    """Основная функция для парсинга и сохранения"""
-    logger.info("Запуск парсера валютных курсов")
-    logger.info(f"Используется БД: {DB_PATH}")
-    
-    # Проверка и инициализация БД
+def get_saved_keys():
+    """Возвращает множество (date_time, type_currency, name_currency), уже записанных в БД"""
+    conn = None
+    try:
+        conn = connect_db_with_retry()
+        if conn is None:
+            return None
+        cursor = conn.cursor()
+        cursor.execute("""
+        SELECT DISTINCT date_time, type_currency, name_currency
+        FROM exchange_rates
+        """)
+        return set(cursor.fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка чтения БД: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def replay_archive(save=False, archive_dir=None):
+    """Повторно разбирает сохраненные HTML-страницы без обращения к сайту.
+
+    Для каждой страницы выводит покрытие (банки и курсы) и время разбора.
+    При save=True дописывает в БД только отсутствующие там данные.
+    """
+    try:
+        entries = read_archive_index(archive_dir)
+    except (OSError, UnicodeDecodeError) as e:
+        logger.error(f"Не удалось прочитать индекс архива HTML: {e}")
+        return None
+    if not entries:
+        logger.warning(f"Архив HTML пуст: {get_archive_index_path(archive_dir)}")
+        return None
+
+    saved_keys = set()
+    if save:
+        saved_keys = get_saved_keys()
+        if saved_keys is None:
+            return None
+
+    logger.info(f"Повторный разбор {len(entries)} страниц из архива")
+    total_banks = 0
+    total_rates = 0
+    failed_pages = 0
+    backfill = []
+    start_time = time.time()
+
+    for entry in entries:
+        digest = entry.get("sha256", "")
+        date_time = entry.get("date_time")
+        if not date_time or not isinstance(date_time, str):
+            # Без времени загрузки строки попали бы в БД с пустой date_time
+            logger.error(f"{digest[:12]}: в индексе архива нет date_time, страница пропущена")
+            failed_pages += 1
+            continue
+        try:
+            html_content = load_archived_html(digest, archive_dir)
+        except (OSError, EOFError, UnicodeDecodeError, zlib.error) as e:
+            logger.error(f"{date_time} {digest[:12]}: не удалось прочитать страницу: {e}")
+            failed_pages += 1
+            continue
+
+        page_start = time.time()
+        currencies, problems = extract_currency_data(html_content, date_time)
+        page_duration = time.time() - page_start
+
+        rates_count = sum(
+            1 for bank in currencies for rate in bank["rates"]
+            if parse_rate(rate["buy"]) is not None and parse_rate(rate["sell"]) is not None
+        )
+        total_banks += len(currencies)
+        total_rates += rates_count
+        if problems:
+            failed_pages += 1
+
+        log = logger.warning if problems else logger.info
+        log(
+            f"{date_time} {digest[:12]}: банков {len(currencies)}/{EXPECTED_BANKS}, "
+            f"курсов {rates_count}/{EXPECTED_RATES}, {page_duration * 1000:.1f} мс"
+        )
+        for problem in problems:
+            logger.warning(f"  {problem}")
+
+        if save:
+            # Дозаписываем только отсутствующие в БД курсы, а не банки целиком:
+            # после исправления селектора часть валют банка уже может быть сохранена
+            for bank in currencies:
+                missing_rates = []
+                for rate in bank["rates"]:
+                    key = (bank["date_time"], bank["bank_name"], rate["currency"])
+                    if key in saved_keys:
+                        continue
+                    if parse_rate(rate["buy"]) is None or parse_rate(rate["sell"]) is None:
+                        continue
+                    saved_keys.add(key)
+                    missing_rates.append(rate)
+                if missing_rates:
+                    backfill.append({**bank, "rates": missing_rates})
+
+    total_duration = time.time() - start_time
+    coverage = total_rates / (EXPECTED_RATES * len(entries)) * 100
+    logger.info(
+        f"Итого: страниц {len(entries)}, с ошибками {failed_pages}, "
+        f"курсов {total_rates}/{EXPECTED_RATES * len(entries)} ({coverage:.1f}%), "
+        f"время {total_duration:.2f} сек"
+    )
+
+    saved_count = 0
+    if save:
+        if backfill:
+            saved_count = save_to_database(backfill)
+        else:
+            logger.info("Нет новых данных для дозаписи в БД")
+
+    return {
+        "pages": len(entries),
+        "failed_pages": failed_pages,
+        "banks": total_banks,
+        "rates": total_rates,
+        "coverage": coverage,
+        "saved": saved_count,
+        "duration": total_duration
+    }
+
+def prepare_database():
+    """Проверяет и при необходимости инициализирует БД"""
     if not os.path.exists(DB_PATH):
         logger.info("Первоначальная инициализация БД")
         if not init_database():
             logger.error("Не удалось инициализировать базу данных")
-            return
+            return False
     elif not check_database_initialized():
         logger.error("Проблемы с структурой БД")
+        return False
+    return True
+
+def main():
+    """Основная функция для парсинга и сохранения"""
+    logger.info("Запуск парсера валютных курсов")
+    logger.info(f"Используется БД: {DB_PATH}")
+    
+    # Проверка и инициализация БД
+    if not prepare_database():
         return
     
     # Парсинг данных
@@ -277,5 +593,26 @@ def main():
     
     logger.info(f"Общее время работы: {time.time() - start_time:.2f} сек")
 
+def replay_main(save, archive_dir=None):
+    """Повторный разбор архива HTML (с дозаписью в БД при save=True)"""
+    logger.info(f"Повторный разбор архива: {archive_dir or ARCHIVE_DIR}")
+    if save:
+        logger.info(f"Используется БД: {DB_PATH}")
+        if not prepare_database():
+            return
+    replay_archive(save=save, archive_dir=archive_dir)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="Парсер валютных курсов")
+    arg_parser.add_argument('--replay', action='store_true',
+                            help="разобрать сохраненные HTML-страницы без запросов к сайту")
+    arg_parser.add_argument('--save', action='store_true',
+                            help="при --replay дописать недостающие данные в БД")
+    arg_parser.add_argument('--archive-dir', default=ARCHIVE_DIR,
+                            help="каталог архива HTML для --replay")
+    args = arg_parser.parse_args()
+
+    if args.replay:
+        replay_main(args.save, args.archive_dir)
+    else:
+        main()
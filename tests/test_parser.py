@@ -0,0 +1,257 @@
+import gzip
+import json
+import os
+import sqlite3
+
+import pytest
+
+import parser
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+DATE_TIME = '2025-07-05 12:00'
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def rates_by_currency(bank):
+    return {rate["currency"]: (rate["buy"], rate["sell"]) for rate in bank["rates"]}
+
+
+@pytest.fixture
+def archive_dir(tmp_path):
+    return str(tmp_path / 'html_archive')
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'currency_data.db')
+    monkeypatch.setattr(parser, 'DB_PATH', path)
+    assert parser.init_database()
+    return path
+
+
+def fetch_rows(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("""
+        SELECT date_time, type_currency, name_currency, buying_rate, selling_rate
+        FROM exchange_rates
+        ORDER BY type_currency, name_currency
+        """).fetchall()
+    finally:
+        conn.close()
+
+
+def test_extract_full_page():
+    currencies, problems = parser.extract_currency_data(load_fixture('myfin_minsk.html'), DATE_TIME)
+
+    assert problems == []
+    assert [bank["bank_name"] for bank in currencies] == ["Лучший курс", "БелВЭБ"]
+    assert all(bank["date_time"] == DATE_TIME for bank in currencies)
+    assert rates_by_currency(currencies[0]) == {
+        "USD": ("3,2850", "3,2650"),
+        "EUR": ("3,5200", "3,4800"),
+        "RUB 100": ("3,6900", "3,6100"),
+    }
+    assert rates_by_currency(currencies[1])["RUB 100"] == ("3,6800", "3,6200")
+
+
+def test_extract_reports_missing_spans_and_belveb_row():
+    currencies, problems = parser.extract_currency_data(
+        load_fixture('myfin_minsk_new_layout.html'), DATE_TIME
+    )
+
+    assert currencies == []
+    assert len(problems) == 2
+    assert "span.accent" in problems[0]
+    assert "БелВЭБ: строка не найдена" in problems[1]
+
+
+def test_extract_reports_missing_belveb_cells():
+    html = (
+        '<span class="accent">3,27</span>' * 6
+        + '<table><tr class="currencies-courses__row-main"><td>BelVEB</td>'
+        + '<td class="currencies-courses__currency-cell"><span>3,27</span></td>'
+        + '</tr></table>'
+    )
+    currencies, problems = parser.extract_currency_data(html, DATE_TIME)
+
+    assert [bank["bank_name"] for bank in currencies] == ["Лучший курс"]
+    assert problems == ["БелВЭБ: найдено 1 ячеек курсов, ожидалось 6"]
+
+
+def test_extract_reports_non_numeric_value():
+    currencies, problems = parser.extract_currency_data(
+        load_fixture('myfin_minsk_bad_rub.html'), DATE_TIME
+    )
+
+    assert len(currencies) == 2
+    assert problems == ["БелВЭБ RUB 100: некорректное значение sell='x'"]
+
+
+def test_archive_round_trip_deduplicates_content(archive_dir):
+    html = load_fixture('myfin_minsk.html')
+
+    digest = parser.archive_html(html, DATE_TIME, parser.SOURCE_URL, archive_dir)
+    assert parser.archive_html(html, '2025-07-05 13:00', parser.SOURCE_URL, archive_dir) == digest
+
+    assert os.listdir(os.path.join(archive_dir, digest[:2])) == [f"{digest}.html.gz"]
+    assert parser.load_archived_html(digest, archive_dir) == html
+    entries = parser.read_archive_index(archive_dir)
+    assert [entry["date_time"] for entry in entries] == [DATE_TIME, '2025-07-05 13:00']
+    assert all(entry["sha256"] == digest for entry in entries)
+
+
+def test_read_archive_index_skips_corrupt_lines(archive_dir):
+    parser.archive_html(load_fixture('myfin_minsk.html'), DATE_TIME, parser.SOURCE_URL, archive_dir)
+    with open(parser.get_archive_index_path(archive_dir), 'a', encoding='utf-8') as f:
+        f.write('{"sha256": "обрыв\n')
+
+    assert len(parser.read_archive_index(archive_dir)) == 1
+
+
+def test_replay_reports_coverage(archive_dir):
+    parser.archive_html(load_fixture('myfin_minsk.html'), DATE_TIME, parser.SOURCE_URL, archive_dir)
+    parser.archive_html(
+        load_fixture('myfin_minsk_new_layout.html'), '2025-07-05 13:00', parser.SOURCE_URL, archive_dir
+    )
+
+    stats = parser.replay_archive(archive_dir=archive_dir)
+
+    assert stats["pages"] == 2
+    assert stats["failed_pages"] == 1
+    assert stats["banks"] == 2
+    assert stats["rates"] == parser.EXPECTED_RATES
+    assert stats["coverage"] == pytest.approx(50.0)
+    assert stats["saved"] == 0
+
+
+def test_replay_save_is_idempotent(archive_dir, db_path):
+    parser.archive_html(load_fixture('myfin_minsk.html'), DATE_TIME, parser.SOURCE_URL, archive_dir)
+
+    assert parser.replay_archive(save=True, archive_dir=archive_dir)["saved"] == parser.EXPECTED_RATES
+    assert parser.replay_archive(save=True, archive_dir=archive_dir)["saved"] == 0
+    assert len(fetch_rows(db_path)) == parser.EXPECTED_RATES
+
+
+def test_replay_backfills_rates_skipped_by_live_run(archive_dir, db_path):
+    # Живой запуск сохранил всё, кроме нераспознанного курса RUB 100 БелВЭБ
+    currencies, _ = parser.extract_currency_data(load_fixture('myfin_minsk_bad_rub.html'), DATE_TIME)
+    assert parser.save_to_database(currencies) == parser.EXPECTED_RATES - 1
+
+    # После исправления извлечения архивная страница дает недостающий курс
+    parser.archive_html(load_fixture('myfin_minsk.html'), DATE_TIME, parser.SOURCE_URL, archive_dir)
+    assert parser.replay_archive(save=True, archive_dir=archive_dir)["saved"] == 1
+
+    rows = fetch_rows(db_path)
+    assert len(rows) == parser.EXPECTED_RATES
+    assert (DATE_TIME, "БелВЭБ", "RUB 100", 3.68, 3.62) in rows
+
+
+def test_replay_skips_entries_without_date_time(archive_dir, db_path):
+    digest = parser.archive_html(load_fixture('myfin_minsk.html'), DATE_TIME, parser.SOURCE_URL, archive_dir)
+    with open(parser.get_archive_index_path(archive_dir), 'w', encoding='utf-8') as f:
+        f.write(json.dumps({"sha256": digest, "url": parser.SOURCE_URL}) + "\n")
+
+    stats = parser.replay_archive(save=True, archive_dir=archive_dir)
+
+    assert stats["failed_pages"] == 1
+    assert stats["saved"] == 0
+    assert fetch_rows(db_path) == []
+
+
+def test_prune_archive_removes_expired_pages(archive_dir):
+    old_html = load_fixture('myfin_minsk_new_layout.html')
+    shared_html = load_fixture('myfin_minsk.html')
+    old_digest = parser.archive_html(old_html, '2025-06-01 12:00', parser.SOURCE_URL, archive_dir)
+    shared_digest = parser.archive_html(shared_html, '2025-06-01 13:00', parser.SOURCE_URL, archive_dir)
+    parser.archive_html(shared_html, DATE_TIME, parser.SOURCE_URL, archive_dir)
+
+    assert parser.prune_archive('2025-07-01 00:00', archive_dir) == 1
+
+    entries = parser.read_archive_index(archive_dir)
+    assert [entry["date_time"] for entry in entries] == [DATE_TIME]
+    assert not os.path.exists(os.path.join(archive_dir, old_digest[:2], f"{old_digest}.html.gz"))
+    assert parser.load_archived_html(shared_digest, archive_dir) == shared_html
+    assert parser.prune_archive('2025-07-01 00:00', archive_dir) == 0
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, 30),
+    ("7", 7),
+    ("abc", 30),
+    ("0", 30),
+    ("-5", 30),
+])
+def test_archive_retention_days_from_env(monkeypatch, value, expected):
+    if value is None:
+        monkeypatch.delenv('PARSER_ARCHIVE_RETENTION_DAYS', raising=False)
+    else:
+        monkeypatch.setenv('PARSER_ARCHIVE_RETENTION_DAYS', value)
+
+    assert parser.get_archive_retention_days() == expected
+
+
+def test_read_archive_index_skips_invalid_entries(archive_dir):
+    parser.archive_html(load_fixture('myfin_minsk.html'), DATE_TIME, parser.SOURCE_URL, archive_dir)
+    with open(parser.get_archive_index_path(archive_dir), 'a', encoding='utf-8') as f:
+        f.write('"x"\n[1]\n{"date_time": "2025-07-05 13:00"}\n{"sha256": 5}\n')
+
+    entries = parser.read_archive_index(archive_dir)
+    assert [entry["date_time"] for entry in entries] == [DATE_TIME]
+
+
+@pytest.fixture
+def live_archive(archive_dir, monkeypatch):
+    monkeypatch.setattr(parser, 'ARCHIVE_ENABLED', True)
+    monkeypatch.setattr(parser, 'ARCHIVE_DIR', archive_dir)
+    monkeypatch.setattr(parser, 'fetch_currency_data', lambda url: load_fixture('myfin_minsk.html'))
+    return archive_dir
+
+
+def test_parse_survives_invalid_archive_index(live_archive):
+    os.makedirs(live_archive)
+    with open(parser.get_archive_index_path(live_archive), 'w', encoding='utf-8') as f:
+        f.write('"x"\n')
+
+    currencies = parser.parse_currency_data()
+
+    assert len(currencies) == 2
+    assert len(parser.read_archive_index(live_archive)) == 1
+
+
+def test_parse_survives_archive_errors(live_archive, monkeypatch):
+    def broken_prune(cutoff, archive_dir=None):
+        raise PermissionError("нет доступа")
+
+    monkeypatch.setattr(parser, 'prune_archive', broken_prune)
+
+    assert len(parser.parse_currency_data()) == 2
+
+
+def test_replay_continues_after_corrupted_page_and_invalid_entry(archive_dir, db_path):
+    parser.archive_html(load_fixture('myfin_minsk.html'), DATE_TIME, parser.SOURCE_URL, archive_dir)
+    broken_digest = parser.archive_html(
+        load_fixture('myfin_minsk_bad_rub.html'), '2025-07-05 13:00', parser.SOURCE_URL, archive_dir
+    )
+    with open(parser.get_archive_index_path(archive_dir), 'a', encoding='utf-8') as f:
+        f.write('"x"\n')
+    parser.archive_html(load_fixture('myfin_minsk.html'), '2025-07-05 14:00', parser.SOURCE_URL, archive_dir)
+
+    # Портим поток deflate сразу за 10-байтовым заголовком gzip (zlib.error, а не OSError)
+    broken_path = os.path.join(archive_dir, broken_digest[:2], f"{broken_digest}.html.gz")
+    data = bytearray(gzip.compress(load_fixture('myfin_minsk_bad_rub.html').encode('utf-8')))
+    for i in range(10, 14):
+        data[i] ^= 0xff
+    with open(broken_path, 'wb') as f:
+        f.write(data)
+
+    stats = parser.replay_archive(save=True, archive_dir=archive_dir)
+
+    assert stats["pages"] == 3
+    assert stats["failed_pages"] == 1
+    assert stats["saved"] == 2 * parser.EXPECTED_RATES
+    assert {row[0] for row in fetch_rows(db_path)} == {DATE_TIME, '2025-07-05 14:00'}